@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import torch as th
 import cherry as ch
 from cherry._utils import _min_size, _istensorable
 from .base import Wrapper
@@ -10,53 +11,54 @@ from collections.abc import Iterable
 
 def flatten_episodes(replay, episodes, num_workers):
     """
-    TODO: This implementation is not efficient.
+    Gathers the first `episodes` completed episodes of a vectorized replay
+    into a flat replay, ordered by completion time.
+
+    Each field is gathered in a single indexing operation over all
+    (timestep, worker) pairs, instead of appending transitions one by one.
 
     NOTE: Additional info (other than a transition's default fields) is simply copied.
     To know from which worker the data was gathered, you can access sars.runner_id
     TODO: This is not great. What is the best behaviour with infos here ?
     """
     flat_replay = ch.ExperienceReplay()
-    worker_replays = [ch.ExperienceReplay() for w in range(num_workers)]
-    flat_episodes = 0
-    for sars in replay:
-        state = sars.state.view(_min_size(sars.state))
-        action = sars.action.view(_min_size(sars.action))
-        reward = sars.reward.view(_min_size(sars.reward))
-        next_state = sars.next_state.view(_min_size(sars.next_state))
-        done = sars.done.view(_min_size(sars.done))
-        fields = set(sars._Transition__fields) - {'state', 'action', 'reward', 'next_state', 'done'}
-        infos = {f: getattr(sars, f) for f in fields}
-        for worker in range(num_workers):
-            infos['runner_id'] = worker
-            # The following attemps to split additional infos. (WIP. Remove ?)
-            # infos = {}
-            # for f in fields:
-            #     value = getattr(sars, f)
-            #     if isinstance(value, Iterable) and len(value) == num_workers:
-            #         value = value[worker]
-            #     elif _istensorable(value):
-            #         tvalue = ch.totensor(value)
-            #         tvalue = tvalue.view(_min_size(tvalue))
-            #         if tvalue.size(0) == num_workers:
-            #             value = tvalue[worker]
-            #     infos[f] = value
-            worker_replays[worker].append(state[worker],
-                                          action[worker],
-                                          reward[worker],
-                                          next_state[worker],
-                                          done[worker],
-                                          **infos,
-                                          )
-            if bool(done[worker]):
-                flat_replay += worker_replays[worker]
-                worker_replays[worker] = ch.ExperienceReplay()
-                flat_episodes += 1
-            if flat_episodes >= episodes:
-                break
-        if flat_episodes >= episodes:
-            break
-    return flat_replay
+    if len(replay) == 0:
+        return flat_replay
+    num_steps = len(replay)
+    dones = replay.done().view(num_steps, num_workers)
+    ends = th.nonzero(dones)[:episodes].tolist()
+    if len(ends) == 0:
+        return flat_replay
+
+    # Collect the (timestep, worker) pair of each flattened transition
+    starts = [0] * num_workers
+    steps_idx, workers_idx = [], []
+    for end, worker in ends:
+        steps_idx.append(th.arange(starts[worker], end + 1))
+        workers_idx.append(th.full((end + 1 - starts[worker], ), worker, dtype=th.long))
+        starts[worker] = end + 1
+    steps_idx = th.cat(steps_idx, dim=0)
+    workers_idx = th.cat(workers_idx, dim=0)
+    size = steps_idx.size(0)
+
+    bufs, shapes = {}, {}
+    for name, column in replay._bufs.items():
+        shape = replay._shapes[name]
+        if name in ('state', 'action', 'reward', 'next_state', 'done'):
+            value = replay._access_property(name)
+            value = value[steps_idx.to(value.device), workers_idx.to(value.device)]
+            row = ch.totensor(value[0])
+            shapes[name] = row.size()
+            bufs[name] = value.reshape((size, ) + _min_size(row))
+        elif isinstance(column, th.Tensor):
+            shapes[name] = shape
+            bufs[name] = column.index_select(0, steps_idx.to(column.device))
+        else:
+            shapes[name] = shape
+            bufs[name] = [column[t] for t in steps_idx.tolist()]
+    shapes['runner_id'] = th.Size([1, 1])
+    bufs['runner_id'] = workers_idx.to(th.get_default_dtype()).view(size, 1)
+    return flat_replay._new(bufs, size, None, shapes)
 
 
 class Runner(Wrapper):
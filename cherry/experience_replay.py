@@ -1,15 +1,107 @@
 #!/usr/bin/env python3
 
+import operator
 import random
 import torch as th
 
+from collections.abc import Sequence
+
 import cherry as ch
 from cherry._utils import _istensorable, _min_size
 
 """
-TODO: replay.astype(dtype) + init dtype
+TODO: replay.astype(dtype)
 """
 
+# Placeholder for transitions that lack a given field.
+_MISSING = object()
+
+
+if hasattr(th.Tensor, 'as_subclass'):  # torch >= 1.7
+
+    class _CallableTensor(th.Tensor):
+
+        """
+        Tensor returned when accessing a replay property.
+
+        Calling it returns itself, so that both `replay.state` and
+        `replay.state()` are supported. Operations on it return regular tensors.
+        """
+
+        __torch_function__ = th._C._disabled_torch_function_impl
+
+        def __call__(self):
+            return self
+
+        def __repr__(self):
+            return repr(self.as_subclass(th.Tensor))
+
+        def __reduce_ex__(self, protocol):
+            # Serialize as a regular tensor, loadable without this class.
+            return self.as_subclass(th.Tensor).__reduce_ex__(protocol)
+
+    def _callable(tensor):
+        return tensor.as_subclass(_CallableTensor)
+
+else:
+
+    def _callable(tensor):
+        return lambda: tensor
+
+
+if hasattr(th, 'can_cast'):  # torch >= 1.5
+    _can_cast = th.can_cast
+else:
+
+    def _can_cast(src, dst):
+        return src == dst or (dst.is_floating_point and not src.is_floating_point)
+
+
+class _CallableList(list):
+
+    """
+    List counterpart of `_CallableTensor`, for non-tensor properties.
+    """
+
+    def __call__(self):
+        return self
+
+
+def _totensor(value):
+    # Tensors only need ch.totensor's reshaping; skip its type dispatch.
+    if isinstance(value, th.Tensor):
+        while value.dim() < 2:
+            value = value.unsqueeze(0)
+        return value
+    return ch.totensor(value)
+
+
+def _detach(tensor):
+    return tensor.detach() if tensor.requires_grad else tensor
+
+
+def _ranges(starts, stops):
+    """
+    Concatenation of range(start, stop) for each pair, without a Python loop.
+    """
+    lengths = stops - starts
+    offsets = th.cumsum(lengths, dim=0) - lengths
+    total = int(lengths.sum())
+    shifts = th.repeat_interleave(offsets - starts, lengths)
+    return th.arange(total, device=starts.device) - shifts
+
+
+def _coalescable(column, device):
+    if device is None or len(column) == 0:
+        return False
+    first = column[0]
+    if not isinstance(first, th.Tensor) or first.device == device:
+        return False
+    return all(isinstance(v, th.Tensor)
+               and v.size() == first.size()
+               and v.dtype == first.dtype
+               and v.device == first.device for v in column)
+
 
 class Transition(object):
 
@@ -59,6 +151,16 @@ class Transition(object):
             setattr(self, key, infos[key])
         self.device = device
 
+    @classmethod
+    def _from_dict(cls, fields, device=None):
+        # Fast path for internal construction: fills __dict__ directly
+        # instead of registering fields one setattr at a time.
+        transition = object.__new__(cls)
+        transition.__dict__.update(fields)
+        transition.__fields = list(fields)
+        transition.device = device
+        return transition
+
     def __str__(self):
         string = 'Transition(' + ', '.join(self.__fields)
         if self.device is not None:
@@ -78,14 +180,14 @@ class Transition(object):
     def _apply(self, fn, device=None):
         if device is None:
             device = self.device
-        new_transition = {'device': device}
+        new_transition = {}
         for field in self.__fields:
             value = getattr(self, field)
             if isinstance(value, th.Tensor):
-                new_transition[field] = fn(value)
+                new_transition[field] = fn(value, value.dtype.is_floating_point)
             else:
                 new_transition[field] = value
-        return Transition(**new_transition)
+        return Transition._from_dict(new_transition, device)
 
     def to(self, *args, **kwargs):
         """
@@ -111,16 +213,16 @@ class Transition(object):
 
         """
         device, dtype, non_blocking, *_ = th._C._nn._parse_to(*args, **kwargs)
-        return self._apply(lambda t: t.to(device, dtype if t.is_floating_point() else None, non_blocking), device)
+        return self._apply(lambda t, floating: t.to(device, dtype if floating else None, non_blocking), device)
 
     def half(self):
-        return self._apply(lambda t: t.half() if t.is_floating_point() else t)
+        return self._apply(lambda t, floating: t.half() if floating else t)
 
     def double(self):
-        return self._apply(lambda t: t.double() if t.is_floating_point() else t)
+        return self._apply(lambda t, floating: t.double() if floating else t)
 
 
-class ExperienceReplay(list):
+class ExperienceReplay(object):
 
     """
     [[Source]](https://github.com/seba-1511/cherry/blob/master/cherry/experience_replay.py)
@@ -140,6 +242,18 @@ class ExperienceReplay(list):
     as a concatenated Tensor.
     Otherwise, they default to a list of values.
 
+    Internally, tensor fields are stored in one preallocated tensor per field,
+    which grows geometrically as transitions are appended.
+    Accessing a property thus returns a view of the stored data, and indexing
+    the replay returns a `Transition` whose tensors are views of its rows.
+    Slices share the buffers of the replay, so that keeping a window of recent
+    transitions with `replay = replay[-size:]` doesn't copy data on each step.
+    As a consequence, in-place operations on properties, transitions, or
+    slices (e.g. `rewards = replay.reward(); rewards -= rewards.mean()`)
+    modify the data stored in the replay: clone them first to avoid it.
+    Fields that can't be batched (e.g. non-tensor infos, tensors requiring
+    gradients, or fields missing from some transitions) are kept as lists.
+
     **Arguments**
 
     * **states** (Tensor, *optional*, default=None) - Tensor of states.
@@ -149,6 +263,14 @@ class ExperienceReplay(list):
       next_states.
     * **dones** (Tensor, *optional*, default=None) - Tensor of dones.
     * **infos** (list, *optional*, default=None) - List of infos.
+    * **dtypes** (dict, *optional*, default=None) - Maps field names to the
+      dtype they are stored with, e.g. `{'done': torch.bool}` to store dones
+      compactly.
+      Values are cast when appended.
+    * **storage_dtype** (dtype, *optional*, default=None) - Floating dtype
+      (e.g. `torch.bfloat16`) used to store floating fields not listed in
+      `dtypes`.
+      Tensors requiring gradients are kept as-is.
 
     **References**
 
@@ -171,6 +293,7 @@ class ExperienceReplay(list):
     replay.action()  # Tensor of actions
     replay.density()  # list of action_density
     replay.log_prob()  # Tensor of log_probabilities
+    replay.log_prob  # Same as above; the call is optional with torch >= 1.7
 
     new_replay = replay[-10:]  # Last 10 transitions in new_replay
 
@@ -179,27 +302,258 @@ class ExperienceReplay(list):
     ~~~
     """
 
-    def __init__(self, storage=None, device=None):
-        list.__init__(self)
-        if storage is None:
-            storage = []
-        self._storage = storage
+    def __init__(self, storage=None, device=None, dtypes=None, storage_dtype=None):
         self.device = device
+        self.dtypes = {} if dtypes is None else dict(dtypes)
+        self.storage_dtype = storage_dtype
+        self._size = 0
+        # One column per field: either a preallocated (capacity, *size) tensor,
+        # or a list of per-transition values for fields that can't be batched.
+        self._bufs = {}
+        self._shapes = {}
+        # Per tensor column, a list holding the storage offset past the last
+        # row written to its buffer; shared with the slices of this replay.
+        self._tails = {}
+        # Concatenated list-backed fields and done indices, reset on writes.
+        self._cache = {}
+        self._done_idx = None
+        # Per-field pinned host rows, staging appends to CUDA buffers.
+        self._pinned = {}
+        if storage is not None:
+            for sars in storage:
+                self._append_fields({f: getattr(sars, f) for f in sars._Transition__fields})
+
+    @property
+    def _storage(self):
+        return [self._transition(i) for i in range(self._size)]
+
+    def _new(self, bufs, size, device, shapes=None):
+        replay = ExperienceReplay(device=device,
+                                  dtypes=self.dtypes,
+                                  storage_dtype=self.storage_dtype)
+        replay._size = size
+        replay._shapes = dict(self._shapes if shapes is None else shapes)
+        for name, column in bufs.items():
+            if isinstance(column, th.Tensor) and column.requires_grad:
+                shape = replay._shapes[name]
+                column = [row.view(shape) for row in column]
+            replay._bufs[name] = column
+        return replay
+
+    def _grow(self, name, capacity):
+        buf = self._bufs[name]
+        new_buf = th.empty((max(capacity, 2 * self._size), ) + buf.shape[1:],
+                           dtype=buf.dtype,
+                           device=buf.device)
+        new_buf[:self._size].copy_(buf[:self._size])
+        self._bufs[name] = new_buf
+        self._tails[name] = [self._size * new_buf.stride(0)]
+        return new_buf
+
+    def _writable(self, name, count):
+        # Slices keep the spare capacity of their parent's buffers, so that
+        # `replay = replay[-size:]` followed by appends doesn't reallocate.
+        # Rows past the end of a replay are written in place only if no other
+        # replay sharing the buffer wrote there; otherwise the rows are copied.
+        column = self._bufs[name]
+        tail = self._tails.get(name)
+        end = column.storage_offset() + self._size * column.stride(0)
+        if tail is None or tail[0] != end or column.size(0) < self._size + count:
+            column = self._grow(name, self._size + count)
+            tail = self._tails[name]
+            end = tail[0]
+        tail[0] = end + count * column.stride(0)
+        # Write through .data: the appended rows are outside the views
+        # handed out so far, whose version counter autograd may check.
+        return column.data[self._size:self._size + count]
+
+    def _rows(self, name):
+        column = self._bufs[name]
+        if isinstance(column, th.Tensor):
+            shape = self._shapes[name]
+            return [column[i].view(shape) for i in range(self._size)]
+        return column
+
+    def _to_list(self, name):
+        column = self._bufs[name] = self._rows(name)
+        return column
+
+    def _fits(self, column, value):
+        # copy_ converts values whose dtype safely casts to the column's.
+        return isinstance(value, th.Tensor) \
+            and not value.requires_grad \
+            and _can_cast(value.dtype, column.dtype) \
+            and value.numel() == column.shape[1:].numel()
+
+    def _invalidate(self):
+        self._cache = {}
+        self._done_idx = None
+
+    def _cast(self, name, value):
+        dtype = self.dtypes.get(name)
+        if dtype is None and self.storage_dtype is not None \
+                and value.dtype.is_floating_point and not value.requires_grad:
+            dtype = self.storage_dtype
+        if dtype is None:
+            return value
+        return value.to(dtype)
+
+    def _append_fields(self, fields):
+        self._invalidate()
+        size = self._size
+        for name in self._bufs:
+            if name not in fields:
+                self._to_list(name).append(_MISSING)
+        for name, value in fields.items():
+            if isinstance(value, th.Tensor):
+                value = self._cast(name, value)
+            column = self._bufs.get(name)
+            if column is None:
+                self._shapes[name] = value.size() if isinstance(value, th.Tensor) else None
+                if size == 0 and isinstance(value, th.Tensor) and not value.requires_grad:
+                    device = value.device if self.device is None else self.device
+                    column = th.empty((0, ) + _min_size(value),
+                                      dtype=value.dtype,
+                                      device=device)
+                else:
+                    column = [_MISSING] * size
+                self._bufs[name] = column
+            if isinstance(column, th.Tensor) and self._fits(column, value):
+                row = self._writable(name, 1)
+                if value.shape != row.shape:  # Usually (1, *size) already
+                    value = value.reshape(row.shape)
+                if row.is_cuda and not value.is_cuda:
+                    self._copy_pinned(name, row, value)
+                else:
+                    row.copy_(value)
+            else:
+                if isinstance(value, th.Tensor) and self.device is not None:
+                    value = value.to(self.device)
+                self._to_list(name).append(value)
+        self._size += 1
+
+    def _copy_pinned(self, name, row, value):
+        # Host-to-device copies only run asynchronously from pinned memory, so
+        # rows go through a pinned staging buffer which is reused once the
+        # copy issued by the previous append has completed.
+        staging, copied = self._pinned.get(name, (None, None))
+        if staging is None \
+                or staging.shape != value.shape \
+                or staging.dtype != value.dtype:
+            staging = th.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            copied = th.cuda.Event()
+        else:
+            copied.synchronize()
+        staging.copy_(value)
+        with th.cuda.device(row.device):
+            row.copy_(staging, non_blocking=True)
+            copied.record()
+        self._pinned[name] = (staging, copied)
+
+    def _extend(self, other):
+        self._invalidate()
+        if len(self._bufs) == 0:
+            for name, column in other._bufs.items():
+                column = column[:other._size]
+                if isinstance(column, th.Tensor):
+                    column = self._cast(name, column)
+                self._bufs[name] = column
+            self._shapes = dict(other._shapes)
+            self._size = other._size
+            return
+        if other._size == 0:
+            return
+        size, other_size = self._size, other._size
+        names = list(self._bufs) + [f for f in other._bufs if f not in self._bufs]
+        for name in names:
+            column = self._bufs.get(name)
+            other_column = other._bufs.get(name)
+            if column is None:
+                self._shapes[name] = other._shapes[name]
+                column = self._bufs[name] = [_MISSING] * size
+            if isinstance(column, th.Tensor) \
+                    and isinstance(other_column, th.Tensor) \
+                    and _can_cast(self._cast(name, other_column[:0]).dtype, column.dtype) \
+                    and other_column.shape[1:].numel() == column.shape[1:].numel():
+                rows = other_column[:other_size].reshape((other_size, ) + column.shape[1:])
+                self._writable(name, other_size).copy_(rows)
+            elif other_column is None:
+                self._to_list(name).extend([_MISSING] * other_size)
+            else:
+                self._to_list(name).extend(other._rows(name))
+        self._size += other_size
+
+    def _transition(self, idx):
+        fields = {}
+        for name, column in self._bufs.items():
+            if isinstance(column, th.Tensor):
+                fields[name] = column[idx].view(self._shapes[name])
+            elif column[idx] is not _MISSING:
+                fields[name] = column[idx]
+        return Transition._from_dict(fields, self.device)
+
+    def _select(self, indices):
+        indices = th.as_tensor(indices, dtype=th.long)
+        device_indices = {indices.device: indices}
+        bufs = {}
+        for name, column in self._bufs.items():
+            if isinstance(column, th.Tensor):
+                if column.device not in device_indices:
+                    device_indices[column.device] = indices.to(column.device)
+                bufs[name] = column.index_select(0, device_indices[column.device])
+            else:
+                bufs[name] = [column[i] for i in indices.tolist()]
+        return self._new(bufs, indices.size(0), self.device)
+
+    def _apply(self, fn, device, coalesce=False):
+        bufs = {}
+        for name, column in self._bufs.items():
+            if isinstance(column, th.Tensor):
+                bufs[name] = fn(column[:self._size], column.dtype.is_floating_point)
+            elif coalesce and _coalescable(column, device):
+                # One transfer for the whole field; stacking keeps the rows'
+                # autograd history.
+                rows = th.stack(column, dim=0)
+                bufs[name] = list(fn(rows, rows.dtype.is_floating_point).unbind(0))
+            else:
+                bufs[name] = [fn(v, v.dtype.is_floating_point) if isinstance(v, th.Tensor) else v
+                              for v in column]
+        return self._new(bufs, self._size, device)
 
     def _access_property(self, name):
-        try:
-            values = [getattr(sars, name) for sars in self._storage]
-        except AttributeError:
-            msg = 'Attribute ' + name + ' not in replay.'
-            raise AttributeError(msg)
-        true_size = _min_size(values[0])
-        return th.cat(values, dim=0).view(len(values), *true_size)
+        if name in self._cache:
+            return self._cache[name]
+        column = self._bufs.get(name)
+        if isinstance(column, th.Tensor):
+            value = column[:self._size]
+        else:
+            if column is None or any(v is _MISSING for v in column):
+                msg = 'Attribute ' + name + ' not in replay.'
+                raise AttributeError(msg)
+            if not all(isinstance(v, th.Tensor) for v in column):
+                return _CallableList(column)
+            first = column[0]
+            true_size = _min_size(first)
+            if all(v.size() == first.size() for v in column):
+                value = th.stack(column, dim=0)
+            else:
+                value = th.stack([v.reshape(true_size) for v in column], dim=0)
+            value = value.view(len(column), *true_size)
+            if any(v.requires_grad for v in column):
+                # Stack on every access, so that the result follows the
+                # current grad mode (e.g. reads under torch.no_grad()).
+                return _callable(value)
+        value = _callable(value)
+        self._cache[name] = value
+        return value
 
-    def __getslice__(self, i, j):
-        return self.__getitem__(slice(i, j))
+    def _done_indices(self):
+        if self._done_idx is None:
+            self._done_idx = th.nonzero(self.done().view(-1)).view(-1)
+        return self._done_idx
 
     def __len__(self):
-        return len(self._storage)
+        return self._size
 
     def __str__(self):
         string = 'ExperienceReplay(' + str(len(self))
@@ -212,44 +566,106 @@ class ExperienceReplay(list):
         return str(self)
 
     def __add__(self, other):
-        storage = self._storage + other._storage
-        return ExperienceReplay(storage)
+        replay = ExperienceReplay(dtypes=self.dtypes, storage_dtype=self.storage_dtype)
+        replay += self
+        # Copy the rows adopted from self, leaving room for other's.
+        for name, column in replay._bufs.items():
+            if isinstance(column, th.Tensor):
+                replay._grow(name, len(self) + len(other))
+        replay += other
+        return replay
+
+    def __radd__(self, other):
+        if isinstance(other, int) and other == 0:  # Start value of sum()
+            return self + ExperienceReplay()
+        return NotImplemented
 
     def __iadd__(self, other):
-        self._storage += other._storage
+        self._extend(other)
         return self
 
     def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        for i in range(self._size):
+            yield self._transition(i)
+
+    def __getstate__(self):
+        # Columns are trimmed to their length, so that copies reallocate
+        # instead of writing into each other's spare capacity; caches and
+        # staging buffers are rebuilt on demand.
+        state = dict(self.__dict__)
+        state['_bufs'] = {name: column[:self._size]
+                          for name, column in self._bufs.items()}
+        state['_tails'] = {}
+        state['_cache'] = {}
+        state['_done_idx'] = None
+        state['_pinned'] = {}
+        return state
 
     def __getattr__(self, attr):
-        return lambda: self._access_property(attr)
+        if '_cache' not in self.__dict__:
+            raise AttributeError(attr)
+        return self._access_property(attr)
 
     def __getitem__(self, key):
-        value = self._storage[key]
         if isinstance(key, slice):
-            return ExperienceReplay(value)
-        return value
-
-    def save(self, path):
+            start, stop, step = key.indices(self._size)
+            if step < 0:
+                return self._select(range(start, stop, step))
+            bufs = {}
+            for name, column in self._bufs.items():
+                if step == 1 and isinstance(column, th.Tensor):
+                    bufs[name] = column[start:]  # Keep the spare capacity
+                else:
+                    bufs[name] = column[:self._size][key]
+            replay = self._new(bufs, len(range(start, stop, step)), self.device)
+            if step == 1:
+                replay._tails = dict(self._tails)
+            return replay
+        idx = operator.index(key)
+        if idx < 0:
+            idx += self._size
+        if not 0 <= idx < self._size:
+            raise IndexError('ExperienceReplay index out of range.')
+        return self._transition(idx)
+
+    def save(self, path, **kwargs):
         """
         **Description**
 
         Serializes and saves the ExperienceReplay into the given path.
 
+        Each tensor field is saved as a single tensor, rather than as one
+        tensor per transition.
+
         **Arguments**
 
         * **path** (str) - File path.
+        * **kwargs** (dict, *optional*) - Passed to `torch.save`.
 
         **Example**
         ~~~python
         replay.save('my_replay_file.pt')
         ~~~
         """
-        th.save(self._storage, path)
-
-    def load(self, path):
+        fields, shapes, missing = {}, {}, {}
+        for name, column in self._bufs.items():
+            shape = self._shapes[name]
+            shapes[name] = None if shape is None else tuple(shape)
+            if isinstance(column, th.Tensor):
+                # Clone to drop the unused capacity of the buffer.
+                fields[name] = column[:self._size].clone()
+            else:
+                missing[name] = [i for i, v in enumerate(column) if v is _MISSING]
+                fields[name] = [None if v is _MISSING else v for v in column]
+        state = {
+            'size': self._size,
+            'fields': fields,
+            'shapes': shapes,
+            'missing': missing,
+        }
+        th.save(state, path, **kwargs)
+
+    def load(self, path, **kwargs):
         """
         **Description**
 
@@ -258,13 +674,27 @@ class ExperienceReplay(list):
         **Arguments**
 
         * **path** (str) - File path of serialized ExperienceReplay.
+        * **kwargs** (dict, *optional*) - Passed to `torch.load`, e.g.
+          `mmap=True` to memory-map the saved tensors (torch >= 2.1).
 
         **Example**
         ~~~python
         replay.load('my_replay_file.pt')
         ~~~
         """
-        self._storage = th.load(path)
+        state = th.load(path, **kwargs)
+        self.empty()
+        if isinstance(state, list):  # Saved as a list of transitions
+            for sars in state:
+                self._append_fields({f: getattr(sars, f) for f in sars._Transition__fields})
+            return
+        bufs = state['fields']
+        for name, idx in state['missing'].items():
+            for i in idx:
+                bufs[name][i] = _MISSING
+        shapes = {name: None if shape is None else th.Size(shape)
+                  for name, shape in state['shapes'].items()}
+        self._extend(self._new(bufs, state['size'], self.device, shapes))
 
     def append(self,
                state=None,
@@ -289,6 +719,11 @@ class ExperienceReplay(list):
         * **infos** (dict, *optional*, default=None) - Additional information
           on the transition.
 
+        Note: The (s, a, r, s', d) fields are detached from the autograd graph
+        before being stored, so that e.g. reparameterized actions don't keep
+        their graph alive. Infos are stored as-is, so that values such as
+        log-probabilities can still be differentiated.
+
         **Example**
         ~~~python
         replay.append(state, action, reward, next_state, done, info={
@@ -299,14 +734,16 @@ class ExperienceReplay(list):
         """
         for key in infos:
             if _istensorable(infos[key]):
-                infos[key] = ch.totensor(infos[key])
-        sars = Transition(ch.totensor(state),
-                          ch.totensor(action),
-                          ch.totensor(reward),
-                          ch.totensor(next_state),
-                          ch.totensor(done),
-                          **infos)
-        self._storage.append(sars.to(self.device))
+                infos[key] = _totensor(infos[key])
+        fields = {
+            'state': _detach(_totensor(state)),
+            'action': _detach(_totensor(action)),
+            'reward': _detach(_totensor(reward)),
+            'next_state': _detach(_totensor(next_state)),
+            'done': _detach(_totensor(done)),
+        }
+        fields.update(infos)
+        self._append_fields(fields)
 
     def sample(self, size=1, contiguous=False, episodes=False):
         """
@@ -316,7 +753,8 @@ class ExperienceReplay(list):
 
         * **size** (int, *optional*, default=1) - The number of samples.
         * **contiguous** (bool, *optional*, default=False) - Whether to sample
-          contiguous transitions.
+          contiguous transitions. Contiguous samples are views sharing
+          memory with the replay, like slices.
         * **episodes** (bool, *optional*, default=False) - Sample full
           episodes, instead of transitions.
 
@@ -326,45 +764,29 @@ class ExperienceReplay(list):
           transitions.
         """
         if len(self) < 1 or size < 1:
-            return ExperienceReplay()
+            return self._new({}, 0, self.device)
 
-        indices = []
         if episodes:
-            if size > 1 and not contiguous:
-                replay = ExperienceReplay()
-                return sum([self.sample(1, episodes=True) for _ in range(size)], replay)
-            else:  # Sample 'size' contiguous episodes
-                num_episodes = self.done().sum().int().item()
-                end = random.randint(size-1, num_episodes-size)
-                # Find idx of the end-th done
-                count = 0
-                dones = self.done()
-                for idx, d in reversed(list(enumerate(dones))):
-                    if bool(d):
-                        if count >= end:
-                            end_idx = idx
-                            break
-                        count += 1
-                # Fill indices
-                indices.insert(0, end_idx)
-                count = 0
-                for idx in reversed(range(0, end_idx)):
-                    if bool(dones[idx]):
-                        count += 1
-                        if count >= size:
-                            break
-                    indices.insert(0, idx)
+            done_idx = self._done_indices()
+            num_episodes = done_idx.size(0)
+            if contiguous:  # Sample 'size' contiguous episodes, as a view
+                end = random.randint(size - 1, num_episodes - 1)
+                start = done_idx[end - size].item() + 1 if end >= size else 0
+                return self[start:done_idx[end].item() + 1]
+            # Each sample spans (done_idx[end - 1], done_idx[end]]
+            ends = th.randint(0, num_episodes, (size, ), device=done_idx.device)
+            starts = done_idx[(ends - 1).clamp(min=0)] + 1
+            starts = th.where(ends >= 1, starts, th.zeros_like(starts))
+            indices = _ranges(starts, done_idx[ends] + 1)
+        elif contiguous:  # A view of the replay, no copy
+            start = random.randint(0, len(self) - 1 - size)
+            return self[start:start + size]
         else:
-            length = len(self) - 1
-            if contiguous:
-                start = random.randint(0, length - size)
-                indices = list(range(start, start + size))
-            else:
-                indices = [random.randint(0, length) for _ in range(size)]
+            device = 'cpu' if self.device is None else self.device
+            indices = th.randint(0, len(self), (size, ), device=device)
 
         # Fill the sample
-        storage = [self[idx] for idx in indices]
-        return ExperienceReplay(storage)
+        return self._select(indices)
 
     def empty(self):
         """
@@ -377,7 +799,11 @@ class ExperienceReplay(list):
         replay.empty()
         ~~~
         """
-        self._storage = []
+        self._size = 0
+        self._bufs = {}
+        self._shapes = {}
+        self._tails = {}
+        self._invalidate()
 
     def cpu(self):
         return self.to('cpu')
@@ -389,10 +815,15 @@ class ExperienceReplay(list):
         """
         **Description**
 
-        Calls `.to()` on all transitions of the experience replay, moving them to the
+        Calls `.to()` on all fields of the experience replay, moving them to the
         desired device and casting the to the desired format.
 
-        Note: This return a new experience replay, but the transitions are modified in-place.
+        Each field is moved with a single transfer. When `non_blocking=True`
+        and moving from CPU to CUDA, fields are first pinned so the copies
+        are actually asynchronous.
+
+        Note: This returns a new experience replay, which shares its data with the
+        original one when no move or cast is required.
 
         **Arguments**
 
@@ -411,13 +842,21 @@ class ExperienceReplay(list):
 
         """
         device, dtype, non_blocking, *_ = th._C._nn._parse_to(*args, **kwargs)
-        storage = [sars.to(*args, **kwargs) for sars in self._storage]
-        return ExperienceReplay(storage, device=device)
+
+        def move(t, floating):
+            if non_blocking and device is not None and device.type == 'cuda' \
+                    and t.device.type == 'cpu':
+                t = t.pin_memory()  # Otherwise the copy is synchronous
+            return t.to(device, dtype if floating else None, non_blocking)
+        return self._apply(move, device, coalesce=True)
 
     def half(self):
-        storage = [sars.half() for sars in self._storage]
-        return ExperienceReplay(storage, device=self.device)
+        return self._apply(lambda t, floating: t.half() if floating else t, self.device)
 
     def double(self):
-        storage = [sars.double() for sars in self._storage]
-        return ExperienceReplay(storage, device=self.device)
+        return self._apply(lambda t, floating: t.double() if floating else t, self.device)
+
+
+# Registered rather than inherited, so that Sequence's mixin methods (e.g.
+# index, count) don't shadow fields of the same name.
+Sequence.register(ExperienceReplay)
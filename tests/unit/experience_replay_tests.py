@@ -5,8 +5,10 @@ import random
 import numpy as np
 import torch as th
 import cherry as ch
+import io
 import os
 import copy
+import pickle
 
 
 NUM_SAMPLES = 100
@@ -145,6 +147,9 @@ class TestExperienceReplay(unittest.TestCase):
                 ids = sample.id()
                 for i, id in enumerate(ids[:-1]):
                     self.assertEqual(id + 1, ids[i+1])
+                start = int(ids[0].item()) - 1
+                self.assertEqual(sample.state().data_ptr(),
+                                 self.replay.state()[start].data_ptr())
 
                 # Test single episode
                 sample = self.replay.sample(size=1, episodes=True)
@@ -174,6 +179,27 @@ class TestExperienceReplay(unittest.TestCase):
                             self.assertEqual(sample[i].id+1,
                                              sample[i+1].id)
 
+    def test_sample_contiguous_episodes(self):
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               i % 7 == 6,
+                               id=i)
+        total_episodes = self.replay.done().sum().int().item()
+        for _ in range(30):
+            for num_episodes in [total_episodes, total_episodes // 2, 1]:
+                sample = self.replay.sample(size=num_episodes,
+                                            contiguous=True,
+                                            episodes=True)
+                self.assertEqual(sample.done().sum().int().item(), num_episodes)
+                self.assertTrue(bool(sample[-1].done.item()))
+                ids = sample.id().view(-1)
+                self.assertTrue(bool((ids[1:] - ids[:-1] == 1).all()))
+                first = ids[0].int().item()
+                self.assertTrue(first == 0 or bool(self.replay[first - 1].done))
+
     def test_append(self):
         new_replay = ch.ExperienceReplay()
         vector = np.random.rand(VECTOR_SIZE)
@@ -196,6 +222,42 @@ class TestExperienceReplay(unittest.TestCase):
         self.replay += new_replay
         self.assertEqual(NUM_SAMPLES * 3, len(self.replay))
 
+    def test_add_chain(self):
+        replays = []
+        for i in range(4):
+            replay = ch.ExperienceReplay()
+            for j in range(NUM_SAMPLES):
+                replay.append(th.randn(VECTOR_SIZE),
+                              th.randn(VECTOR_SIZE),
+                              i,
+                              th.randn(VECTOR_SIZE),
+                              j == NUM_SAMPLES - 1)
+            replays.append(replay)
+        total = sum(replays, ch.ExperienceReplay())
+        states = th.cat([replay.state() for replay in replays], dim=0).clone()
+        rewards = th.cat([replay.reward() for replay in replays], dim=0).clone()
+        # Later writes to the operands are not reflected in the sum
+        replays[0].reward().add_(5)
+        replays[0].append(th.randn(VECTOR_SIZE),
+                          th.randn(VECTOR_SIZE),
+                          0,
+                          th.randn(VECTOR_SIZE),
+                          False)
+        self.assertEqual(len(total), 4 * NUM_SAMPLES)
+        self.assertTrue(close(total.reward(), rewards))
+        self.assertTrue(close(total.state(), states))
+        self.assertEqual([sars.reward.item() for sars in total][::NUM_SAMPLES],
+                         [0, 1, 2, 3])
+        replays[1].reward().add_(5)
+        self.assertTrue(close(total.reward(), rewards))
+        # Nor are writes to sums sharing the same operands
+        first = replays[2] + replays[3]
+        second = first + replays[3]
+        first.state().add_(1)
+        self.assertTrue(close(second.state()[:NUM_SAMPLES], replays[2].state()))
+        self.assertEqual(len(total + total), 8 * NUM_SAMPLES)
+        self.assertTrue(close(sum(replays[1:]).state(), total.state()[NUM_SAMPLES:]))
+
     def test_save_and_load(self):
         old_replay = self.replay
         vector = np.random.rand(VECTOR_SIZE)
@@ -240,6 +302,37 @@ class TestExperienceReplay(unittest.TestCase):
 
         os.remove('testing_temp_file.pt')
 
+    def test_copy(self):
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False,
+                               index=i,
+                               name='sample')
+        self.replay.state()
+        for replay in [copy.copy(self.replay),
+                       copy.deepcopy(self.replay),
+                       pickle.loads(pickle.dumps(self.replay))]:
+            self.assertFalse(isinstance(replay, list))
+            batch = random.sample(replay, 10)
+            self.assertEqual(len(batch), 10)
+            self.assertTrue(all(isinstance(sars, ch.Transition) for sars in batch))
+            self.assertEqual(len(replay), NUM_SAMPLES)
+            self.assertTrue(close(replay.state(), self.replay.state()))
+            self.assertTrue(close(replay.index(), self.replay.reward()))
+            self.assertEqual(replay.name(), self.replay.name())
+            replay.append(th.randn(VECTOR_SIZE),
+                          th.randn(VECTOR_SIZE),
+                          NUM_SAMPLES,
+                          th.randn(VECTOR_SIZE),
+                          True,
+                          index=NUM_SAMPLES,
+                          name='copy')
+            self.assertEqual(len(self.replay), NUM_SAMPLES)
+            self.assertEqual(len(self.replay.name()), NUM_SAMPLES)
+
     def test_replay_myattr(self):
         standard_replay = self.replay
         vector = np.random.rand(VECTOR_SIZE)
@@ -258,6 +351,53 @@ class TestExperienceReplay(unittest.TestCase):
                                    test=test_tensor)
         self.assertTrue(isinstance(standard_replay.test(), th.Tensor))
 
+    def test_property_access(self):
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False,
+                               info={'id': i})
+        self.assertTrue(self.replay.state() is self.replay.state())
+        if hasattr(th.Tensor, 'as_subclass'):
+            self.assertTrue(self.replay.state is self.replay.state())
+            self.assertEqual(type(self.replay.state + 1), th.Tensor)
+        buffer = io.BytesIO()
+        th.save(self.replay.state(), buffer)
+        buffer.seek(0)
+        state = th.load(buffer)
+        self.assertEqual(type(state), th.Tensor)
+        self.assertTrue(close(state, self.replay.state()))
+        self.assertEqual(self.replay.info()[3], {'id': 3})
+        self.assertFalse(hasattr(self.replay, 'not_a_field'))
+        self.replay.append(th.randn(VECTOR_SIZE),
+                           th.randn(VECTOR_SIZE),
+                           NUM_SAMPLES,
+                           th.randn(VECTOR_SIZE),
+                           False,
+                           info={'id': NUM_SAMPLES})
+        self.assertEqual(len(self.replay.state()), NUM_SAMPLES + 1)
+
+    def test_property_views(self):
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False)
+        rewards = self.replay.reward().clone()
+        # Clones are independent from the replay
+        normalized = self.replay.reward().clone()
+        normalized -= normalized.mean()
+        self.assertTrue(close(self.replay.reward(), rewards))
+        # Properties and transitions are views of the stored data
+        normalized = self.replay.reward()
+        normalized -= normalized.mean()
+        self.assertTrue(close(self.replay.reward(), rewards - rewards.mean()))
+        self.replay[0].reward.add_(1)
+        self.assertTrue(close(self.replay.reward()[0], rewards[0] - rewards.mean() + 1))
+
     def test_slices(self):
         for i in range(NUM_SAMPLES):
             self.replay.append(th.randn(VECTOR_SIZE),
@@ -294,12 +434,11 @@ class TestExperienceReplay(unittest.TestCase):
         self.assertEqual(len(replay), len(self.replay))
 
         for cr, sr in zip(replay, self.replay):
-            self.assertTrue(cr.state is sr.state)
-            self.assertTrue(cr.action is sr.action)
-            self.assertTrue(cr.next_state is sr.next_state)
-            self.assertTrue(cr.reward is sr.reward)
-            self.assertTrue(cr.vector is sr.vector)
-            self.assertTrue(cr.vector is sr.vector)
+            self.assertEqual(cr.state.data_ptr(), sr.state.data_ptr())
+            self.assertEqual(cr.action.data_ptr(), sr.action.data_ptr())
+            self.assertEqual(cr.next_state.data_ptr(), sr.next_state.data_ptr())
+            self.assertEqual(cr.reward.data_ptr(), sr.reward.data_ptr())
+            self.assertEqual(cr.vector.data_ptr(), sr.vector.data_ptr())
 
         # Test cuda
         if th.cuda.is_available():
@@ -327,6 +466,126 @@ class TestExperienceReplay(unittest.TestCase):
                 self.assertTrue(close(cr.vector, sr.vector))
                 self.assertTrue(close(cr.vector, sr.vector))
 
+            # Appending host tensors to a CUDA replay
+            for sars in self.replay:
+                cuda_replay.append(sars.state,
+                                   sars.action,
+                                   sars.reward,
+                                   sars.next_state,
+                                   sars.done,
+                                   vector=sars.vector)
+            self.assertTrue(close(cuda_replay[len(self.replay):].state().cpu(),
+                                  self.replay.state()))
+            self.assertTrue(close(cuda_replay[len(self.replay):].vector().cpu(),
+                                  self.replay.vector()))
+
+    def test_slice_append(self):
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False)
+        rewards = self.replay.reward().view(-1).tolist()
+        tail = self.replay[-10:]
+        middle = self.replay[10:20]
+        other_tail = self.replay[-10:]
+        for replay, reward in [(tail, -1), (self.replay, -2), (middle, -3), (other_tail, -4)]:
+            replay.append(th.randn(VECTOR_SIZE),
+                          th.randn(VECTOR_SIZE),
+                          reward,
+                          th.randn(VECTOR_SIZE),
+                          False)
+        self.assertEqual(self.replay.reward().view(-1).tolist(), rewards + [-2])
+        self.assertEqual(tail.reward().view(-1).tolist(), rewards[-10:] + [-1])
+        self.assertEqual(middle.reward().view(-1).tolist(), rewards[10:20] + [-3])
+        self.assertEqual(other_tail.reward().view(-1).tolist(), rewards[-10:] + [-4])
+
+    def test_sliding_window(self):
+        # replay += new_data; replay = replay[-size:] should reuse the buffers
+        window = NUM_SAMPLES
+        reallocations = 0
+        for i in range(10 * window):
+            step = ch.ExperienceReplay()
+            step.append(th.randn(VECTOR_SIZE),
+                        th.randn(VECTOR_SIZE),
+                        i,
+                        th.randn(VECTOR_SIZE),
+                        False)
+            ptr = self.replay.state().data_ptr() if len(self.replay) > 0 else None
+            self.replay += step
+            self.replay = self.replay[-window:]
+            if len(self.replay) == window:
+                row = self.replay.state()[0]
+                if ptr is None or row.data_ptr() != ptr + row.numel() * row.element_size():
+                    reallocations += 1
+        self.assertEqual(len(self.replay), window)
+        self.assertEqual(self.replay.reward().view(-1).tolist(),
+                         list(range(9 * window, 10 * window)))
+        self.assertLessEqual(reallocations, 10)
+
+    def test_append_after_forward(self):
+        weight = th.randn(VECTOR_SIZE, requires_grad=True)
+        for i in range(NUM_SAMPLES):
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False)
+            out = (self.replay.state() * weight).sum()
+            other = ch.ExperienceReplay()
+            other.append(th.randn(VECTOR_SIZE),
+                         th.randn(VECTOR_SIZE),
+                         i,
+                         th.randn(VECTOR_SIZE),
+                         False)
+            # Writes to the buffers don't invalidate saved property views
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False)
+            self.replay += other
+            out.backward()
+
+    def test_grad_infos(self):
+        weight = th.randn(VECTOR_SIZE, requires_grad=True)
+        for i in range(NUM_SAMPLES):
+            state = th.randn(VECTOR_SIZE)
+            self.replay.append(state,
+                               state * weight,
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False,
+                               log_prob=(weight * state).sum())
+        self.assertFalse(self.replay.action().requires_grad)
+        with th.no_grad():
+            self.assertFalse(self.replay.log_prob().requires_grad)
+        log_probs = self.replay.log_prob()
+        self.assertTrue(log_probs.requires_grad)
+        self.assertEqual(log_probs.size(), th.Size([NUM_SAMPLES, 1]))
+        log_probs.sum().backward()
+        self.assertTrue(close(self.replay[0:NUM_SAMPLES:2].log_prob(), log_probs[::2]))
+        self.assertTrue(th.allclose(weight.grad, self.replay.state().sum(0), atol=1e-5))
+
+    def test_missing_infos(self):
+        for i in range(NUM_SAMPLES):
+            infos = {'vector': th.randn(VECTOR_SIZE)} if i % 2 else {}
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               th.randn(VECTOR_SIZE),
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False,
+                               **infos)
+        self.assertEqual(self.replay.state().size(),
+                         th.Size([NUM_SAMPLES, VECTOR_SIZE]))
+        self.assertFalse(hasattr(self.replay[0], 'vector'))
+        self.assertTrue(hasattr(self.replay[1], 'vector'))
+        with self.assertRaises(AttributeError):
+            self.replay.vector()
+        self.assertEqual(self.replay[1::2].vector().size(),
+                         th.Size([NUM_SAMPLES // 2, VECTOR_SIZE]))
+
     def test_to_dtype(self):
         for i in range(NUM_SAMPLES):
             self.replay.append(th.randn(VECTOR_SIZE),
@@ -340,6 +599,76 @@ class TestExperienceReplay(unittest.TestCase):
         i32 = self.replay.to(th.int32)
         i64 = self.replay.to(th.int64)
 
+    def test_dtypes(self):
+        replay = ch.ExperienceReplay(dtypes={'done': th.bool,
+                                             'action': th.long})
+        for i in range(NUM_SAMPLES):
+            replay.append(th.randn(VECTOR_SIZE),
+                          i % 3,
+                          i,
+                          th.randn(VECTOR_SIZE),
+                          i % 10 == 9)
+        self.assertEqual(replay.done().dtype, th.bool)
+        self.assertEqual(replay.action().dtype, th.long)
+        self.assertEqual(replay.reward().dtype, th.get_default_dtype())
+        self.assertEqual(replay.done().sum().item(), NUM_SAMPLES // 10)
+        self.assertEqual(replay[1].action.item(), 1)
+        self.assertEqual(replay.sample(5).done().dtype, th.bool)
+        self.assertEqual(replay.sample(0).dtypes, replay.dtypes)
+        sample = replay.sample(1, episodes=True)
+        self.assertTrue(bool(sample[-1].done))
+
+        self.replay.append(th.randn(VECTOR_SIZE),
+                           1,
+                           0,
+                           th.randn(VECTOR_SIZE),
+                           True)
+        self.replay.append(th.randn(VECTOR_SIZE),
+                           1,
+                           0,
+                           th.randn(VECTOR_SIZE),
+                           True)
+        replay += self.replay
+        self.assertEqual(len(replay), NUM_SAMPLES + 2)
+        self.assertEqual(replay.done().dtype, th.bool)
+
+    def test_mixed_dtypes(self):
+        for i in range(NUM_SAMPLES):
+            action = th.tensor([i]) if i % 2 else i  # float, then int64
+            self.replay.append(th.randn(VECTOR_SIZE),
+                               action,
+                               i,
+                               th.randn(VECTOR_SIZE),
+                               False,
+                               step=th.tensor([i]) if i < 10 else th.tensor([i + 0.5]))
+        # Integers are stored in floating columns
+        self.assertTrue(isinstance(self.replay._bufs['action'], th.Tensor))
+        self.assertEqual(self.replay.action().dtype, th.get_default_dtype())
+        self.assertEqual(self.replay.action().view(-1).tolist(), list(range(NUM_SAMPLES)))
+        # Floats are not truncated into integer columns
+        self.assertEqual(self.replay.step().view(-1).tolist(),
+                         list(range(10)) + [i + 0.5 for i in range(10, NUM_SAMPLES)])
+
+    def test_storage_dtype(self):
+        replay = ch.ExperienceReplay(storage_dtype=th.float16,
+                                     dtypes={'done': th.bool})
+        weight = th.randn(VECTOR_SIZE, requires_grad=True)
+        for i in range(NUM_SAMPLES):
+            replay.append(th.randn(VECTOR_SIZE),
+                          th.randn(VECTOR_SIZE),
+                          i,
+                          th.randn(VECTOR_SIZE),
+                          False,
+                          step=th.tensor([i]),
+                          log_prob=weight.sum())
+        self.assertEqual(replay.state().dtype, th.float16)
+        self.assertEqual(replay.reward().dtype, th.float16)
+        self.assertEqual(replay.done().dtype, th.bool)
+        self.assertEqual(replay.step().dtype, th.long)
+        self.assertEqual(replay.log_prob().dtype, weight.dtype)
+        half = replay.half()
+        self.assertEqual(half.state().data_ptr(), replay.state().data_ptr())
+
     def test_half_double(self):
         for i in range(NUM_SAMPLES):
             self.replay.append(th.randn(VECTOR_SIZE),
@@ -36,6 +36,47 @@ class TestRunnerWrapper(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def test_flatten_episodes(self):
+        num_workers = 2
+        # (step, worker) pairs where an episode ends
+        ends = [(1, 0), (2, 1), (4, 0)]
+        replay = ch.ExperienceReplay()
+        for t in range(6):
+            state = th.tensor([[t, w, 0.0] for w in range(num_workers)])
+            done = th.tensor([float((t, w) in ends) for w in range(num_workers)])
+            replay.append(state,
+                          th.arange(num_workers).float(),
+                          th.ones(num_workers),
+                          state + 1,
+                          done,
+                          act=th.full((num_workers, 2), t),
+                          name='step' + str(t))
+
+        flat = envs.runner_wrapper.flatten_episodes(replay, 3, num_workers)
+        steps = [0, 1, 0, 1, 2, 2, 3, 4]
+        workers = [0, 0, 1, 1, 1, 0, 0, 0]
+        self.assertEqual(len(flat), len(steps))
+        self.assertEqual(flat.state().shape, (len(steps), 3))
+        self.assertEqual(flat.action().shape, (len(steps), 1))
+        self.assertEqual(flat.reward().shape, (len(steps), 1))
+        self.assertEqual(flat.done().shape, (len(steps), 1))
+        self.assertEqual(flat.runner_id().shape, (len(steps), 1))
+        self.assertEqual(flat.state()[:, 0].tolist(), steps)
+        self.assertEqual(flat.state()[:, 1].tolist(), workers)
+        self.assertEqual(flat.next_state()[:, 0].tolist(), [s + 1 for s in steps])
+        self.assertEqual(flat.action().view(-1).tolist(), workers)
+        self.assertEqual(flat.runner_id().view(-1).tolist(), workers)
+        self.assertEqual(flat.done().view(-1).tolist(),
+                         [0, 1, 0, 0, 1, 0, 0, 1])
+        self.assertEqual(flat.act().shape, (len(steps), num_workers, 2))
+        self.assertEqual(flat.act()[:, 0, 0].tolist(), steps)
+        self.assertEqual(flat.name(), ['step' + str(s) for s in steps])
+
+        # Only the first completed episodes are kept
+        flat = envs.runner_wrapper.flatten_episodes(replay, 2, num_workers)
+        self.assertEqual(flat.state()[:, 0].tolist(), steps[:5])
+        self.assertEqual(flat.runner_id().view(-1).tolist(), workers[:5])
+
     def test_vec_episodes(self):
         def test_config(n_envs,
                         n_episodes,